@@ -1,5 +1,6 @@
 import re
-from typing import Dict, List, Optional
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
 
 from overrides import overrides
 
@@ -7,7 +8,120 @@ from server.protocol import (
     CodeAction, Command, CompletionItem, CompletionList, Diagnostic, DiagnosticSeverity, Example,
     Hover, Location, Position, Range, SyntaxHighlight, TextEdit, WorkspaceEdit
 )
-from server.teaspn_handler import TeaspnHandler
+from server.teaspn_handler import TeaspnHandler, memoize_per_revision
+
+_HL_RE = re.compile(r'\b(?:(?P<caps>[A-Z]+)|(?P<num>[0-9]+))\b')
+
+_PRONOUNS = frozenset({'i', 'you', 'we', 'she', 'he', 'they', 'it'})
+_BE_VERBS = frozenset({'am', 'are', 'is', 'were', 'was'})
+_VALID_COMBINATIONS = {
+    'i': frozenset({'am', 'was'}),
+    'you': frozenset({'are', 'were'}),
+    'we': frozenset({'are', 'were'}),
+    'she': frozenset({'is', 'was'}),
+    'he': frozenset({'is', 'was'}),
+    'they': frozenset({'are', 'were'}),
+    'it': frozenset({'is', 'was'})
+}
+
+# Matches a pronoun immediately followed by a be-verb, so that each line is checked in a single
+# pass. Matched words are lowercased and checked again against the sets above, as case-insensitive
+# matching also accepts some non-ASCII letters (e.g., dotted I).
+_AGREEMENT_RE = re.compile(r'\b(?P<pronoun>{})\b[^\w\n]+(?P<verb>{})\b'.format(
+    '|'.join(sorted(_PRONOUNS)), '|'.join(sorted(_BE_VERBS))), re.IGNORECASE)
+
+# Sorted so that words sharing a prefix form a contiguous run found by bisect
+_COMPLETION_WORDS = tuple(sorted((
+    "Assam",
+    "Chai",
+    "Darjeeling",
+    "Earl Grey",
+    "Jasmine",
+    "Matcha",
+    "Oolong",
+    "Puerh"
+)))
+
+_TEA_EXAMPLES = (
+    Example(label="Assam",
+            description="a black tea named after the region of its production, "
+                        "Assam, India."),
+    Example(label="Chai",
+            description="a flavoured tea beverage made by brewing black tea "
+                        "with a mixture of aromatic spices and herbs."),
+    Example(label="Darjeeling",
+            description="a tea grown in the Darjeeling district, Kalimpong District "
+                        "in West Bengal, India, and widely exported and known."),
+    Example(label="Earl Grey",
+            description="a tea blend which has been flavoured "
+                        "with the addition of oil of bergamot."),
+    Example(label="Jasmine",
+            description="tea scented with the aroma of jasmine blossoms."),
+    Example(label="Matcha",
+            description="finely ground powder of specially grown "
+                        "and processed green tea leaves."),
+    Example(label="Oolong",
+            description="a traditional semi-oxidized Chinese tea"),
+    Example(label="Puerh",
+            description="a variety of fermented tea produced "
+                        "in the Yunnan province of China.")
+)
+
+
+def _highlight_line(line_id: int, line_text: str) -> List[SyntaxHighlight]:
+    """
+    Computes highlights of CAPS WORDS and numbers on a single line.
+    """
+    highlights = []
+    for match in _HL_RE.finditer(line_text):
+        rng = Range(Position(line_id, match.start()), Position(line_id, match.end()))
+        if match.lastgroup == 'caps':
+            highlights.append(SyntaxHighlight(range=rng,
+                                              type='blue',
+                                              hoverMessage=f'ALL CAPS: {match.group(0)}'))
+        else:
+            highlights.append(SyntaxHighlight(range=rng,
+                                              type='red',
+                                              hoverMessage=f'numbers: {match.group(0)}'))
+
+    return highlights
+
+
+def _check_agreement(line_id: int, line_text: str) -> Tuple[List[Diagnostic], List[List[str]]]:
+    """
+    Detects subject-verb agreement errors on a single line.
+    Returns the diagnostics and the list of replacements for each of them.
+    """
+    diagnostics = []
+    replacements = []
+    for match in _AGREEMENT_RE.finditer(line_text):
+        w1, w2 = match.group('pronoun', 'verb')
+        l1, l2 = w1.lower(), w2.lower()
+        if l1 not in _PRONOUNS or l2 not in _BE_VERBS:
+            continue
+        if l2 in _VALID_COMBINATIONS[l1]:
+            continue
+
+        rng = Range(Position(line_id, match.start()), Position(line_id, match.end()))
+        diagnostics.append(Diagnostic(range=rng,
+                                      severity=DiagnosticSeverity.Error,
+                                      message='Wrong agreement: {} {}'.format(w1, w2)))
+        replacements.append([f'{w1} {verb}' for verb in _VALID_COMBINATIONS[l1]])
+
+    return diagnostics, replacements
+
+
+def _move_to_line(items: List, line_id: int) -> List:
+    """
+    Given single-line `SyntaxHighlight`s or `Diagnostic`s, returns their copies moved to `line_id`.
+    """
+    moved = []
+    for item in items:
+        start, end = item.range
+        moved.append(item._replace(range=Range(Position(line_id, start.character),
+                                               Position(line_id, end.character))))
+
+    return moved
 
 
 class TeaspnHandlerSample(TeaspnHandler):
@@ -15,74 +129,69 @@ class TeaspnHandlerSample(TeaspnHandler):
     A sample TeaspnHandler implementation with simple writing assistance features.
     """
     def __init__(self):
-        # Manages a mapping from Diagnostic to replacements
-        self._diag_to_replacements: Dict[Diagnostic, List[str]] = {}
+        # Manages a mapping from the (range, message) of a Diagnostic to replacements. Diagnostics
+        # sent back by the client are matched by these two fields only.
+        self._diag_to_replacements: Dict[Tuple[Range, str], List[str]] = {}
+
+        # Per-line caches of highlights and of (diagnostics, replacements), aligned with
+        # `self._lines`. An entry is None if the line needs to be scanned (again). Otherwise, it
+        # also holds the line number the results were computed for, so that results of lines which
+        # were only shifted by an update can be reused after fixing their positions.
+        self._line_highlights: List[Optional[Tuple[int, List[SyntaxHighlight]]]] = [None]
+        self._line_diagnostics: List[
+            Optional[Tuple[int, List[Diagnostic], List[List[str]]]]] = [None]
 
         super().__init__()
 
     @overrides
+    def _on_lines_changed(self, start: int, stop: int, count: int):
+        self._line_highlights[start:stop] = [None] * count
+        self._line_diagnostics[start:stop] = [None] * count
+
+    @overrides
+    @memoize_per_revision
     def highlight_syntax(self) -> List[SyntaxHighlight]:
         """
         Implements sample syntax highlighting where all occurrences of CAPS WORDS and numbers
         are highlighted in different colors with hover messages.
+        Only the lines updated since the last call are scanned again.
         """
         highlights = []
-        for line_id, line_text in enumerate(self._text.splitlines()):
-            for match in re.finditer(r'\b[A-Z]+\b', line_text):
-                rng = Range(start=Position(line=line_id, character=match.start()),
-                            end=Position(line=line_id, character=match.end()))
-                highlights.append(SyntaxHighlight(range=rng,
-                                                  type='blue',
-                                                  hoverMessage=f'ALL CAPS: {match.group(0)}'))
-
-            for match in re.finditer(r'\b[0-9]+\b', line_text):
-                rng = Range(start=Position(line=line_id, character=match.start()),
-                            end=Position(line=line_id, character=match.end()))
-                highlights.append(SyntaxHighlight(range=rng,
-                                                  type='red',
-                                                  hoverMessage=f'numbers: {match.group(0)}'))
+        cache = self._line_highlights
+        for line_id, line_text in enumerate(self._lines):
+            entry = cache[line_id]
+            if entry is None:
+                entry = cache[line_id] = (line_id, _highlight_line(line_id, line_text))
+            elif entry[0] != line_id:
+                entry = cache[line_id] = (line_id, _move_to_line(entry[1], line_id))
+            highlights.extend(entry[1])
 
         return highlights
 
     @overrides
+    @memoize_per_revision
     def get_diagnostics(self) -> List[Diagnostic]:
         """
         Implements sample grammatical error detection (GED) and correction (GEC).
         This checks English subject-verb agreement in statement sentences using hand-crafted rules.
+        Only the lines updated since the last call are checked again.
         """
-        PRONOUNS = ['i', 'you', 'we', 'she', 'he', 'they', 'it']
-        BE_VERBS = ['am', 'are', 'is', 'were', 'was']
-        VALID_COMBINATIONS = {
-            'i': {'am', 'was'},
-            'you': {'are', 'were'},
-            'we': {'are', 'were'},
-            'she': {'is', 'was'},
-            'he': {'is', 'was'},
-            'they': {'are', 'were'},
-            'it': {'is', 'was'}
-        }
+        self._diag_to_replacements.clear()
 
         diagnostics = []
-        for line_id, line_text in enumerate(self._text.splitlines()):
-            matches = list(re.finditer(r'\w+', line_text))
-            for m1, m2 in zip(matches, matches[1:]):
-                w1, w2 = m1.group(0), m2.group(0)
-                if not (w1.lower() in PRONOUNS and w2.lower() in BE_VERBS):
-                    continue
-                if w2.lower() in VALID_COMBINATIONS[w1.lower()]:
-                    continue
-
-                rng = Range(start=Position(line=line_id, character=m1.start(0)),
-                            end=Position(line=line_id, character=m2.end(0)))
-                diagnostic = Diagnostic(range=rng,
-                                        severity=DiagnosticSeverity.Error,
-                                        message='Wrong agreement: {} {}'.format(w1, w2))
-
-                diagnostics.append(diagnostic)
-
-                # Register the diagnostic for later use in GEC
-                replacements = [f'{w1} {verb}' for verb in VALID_COMBINATIONS[w1.lower()]]
-                self._diag_to_replacements[diagnostic] = replacements
+        cache = self._line_diagnostics
+        for line_id, line_text in enumerate(self._lines):
+            entry = cache[line_id]
+            if entry is None:
+                entry = cache[line_id] = (line_id, *_check_agreement(line_id, line_text))
+            elif entry[0] != line_id:
+                entry = cache[line_id] = (line_id, _move_to_line(entry[1], line_id), entry[2])
+            _, line_diagnostics, line_replacements = entry
+            diagnostics.extend(line_diagnostics)
+
+            # Register the diagnostics for later use in GEC
+            for diagnostic, replacements in zip(line_diagnostics, line_replacements):
+                self._diag_to_replacements[(diagnostic.range, diagnostic.message)] = replacements
 
         return diagnostics
 
@@ -91,14 +200,19 @@ class TeaspnHandlerSample(TeaspnHandler):
         """
         Implements GEC for fixing subject-verb agreement errors detected above.
         """
+        diag_to_replacements = self._diag_to_replacements
+        uri = self._uri
+
         actions = []
         for diag in diagnostics:
-            for repl in self._diag_to_replacements[diag]:
-                edit = WorkspaceEdit({self._uri: [TextEdit(range=diag.range, newText=repl)]})
-                command = Command(title='Quick fix: {}'.format(repl),
+            # Replacements of diagnostics from an outdated document may have been discarded
+            for repl in diag_to_replacements.get((diag.range, diag.message), []):
+                title = f'Quick fix: {repl}'
+                edit = WorkspaceEdit({uri: [TextEdit(range=diag.range, newText=repl)]})
+                command = Command(title=title,
                                   command='refactor.rewrite',
                                   arguments=[edit])
-                actions.append(CodeAction(title='Quick fix: {}'.format(repl),
+                actions.append(CodeAction(title=title,
                                           kind='quickfix',
                                           command=command))
         return actions
@@ -132,50 +246,29 @@ class TeaspnHandlerSample(TeaspnHandler):
         Sample search feature which returns a list of tea varieties and their descriptions,
         regardless of the query.
         """
-        return [
-            Example(label="Assam",
-                    description="a black tea named after the region of its production, "
-                                "Assam, India."),
-            Example(label="Chai",
-                    description="a flavoured tea beverage made by brewing black tea "
-                                "with a mixture of aromatic spices and herbs."),
-            Example(label="Darjeeling",
-                    description="a tea grown in the Darjeeling district, Kalimpong District "
-                                "in West Bengal, India, and widely exported and known."),
-            Example(label="Earl Grey",
-                    description="a tea blend which has been flavoured "
-                                "with the addition of oil of bergamot."),
-            Example(label="Jasmine",
-                    description="tea scented with the aroma of jasmine blossoms."),
-            Example(label="Matcha",
-                    description="finely ground powder of specially grown "
-                                "and processed green tea leaves."),
-            Example(label="Oolong",
-                    description="a traditional semi-oxidized Chinese tea"),
-            Example(label="Puerh",
-                    description="a variety of fermented tea produced "
-                                "in the Yunnan province of China.")
-        ]
+        return list(_TEA_EXAMPLES)
 
     @overrides
     def search_definition(self, position: Position, uri: str) -> List[Location]:
         """
         Implements a "go to definition" feature where all occurrence of the target word are returned
+        (whole words only, e.g., "cat" doesn't match "category")
         """
         word = self._get_word_at(position)
+        if not word:
+            return []
+
+        offset_to_position = self._offset_to_position
 
+        # Stdlib re's \w is exactly `str.isalnum() or '_'`, the word definition of `_get_word_at`,
+        # so the word under the cursor always matches itself. The search runs on str rather than
+        # UTF-8 bytes as byte offsets don't map to the character positions LSP clients expect.
         locations = []
-        offset = 0
-        while True:
-            offset = self._text.find(word, offset)
-            if offset == -1:
-                break
-            rng = Range(start=self._offset_to_position(offset),
-                        end=self._offset_to_position(offset + len(word)))
+        for match in re.finditer(r'\b' + re.escape(word) + r'\b', self._text):
+            rng = Range(start=offset_to_position(match.start()),
+                        end=offset_to_position(match.end()))
             locations.append(Location(uri=uri, range=rng))
 
-            offset += 1
-
         return locations
 
     @overrides
@@ -183,24 +276,15 @@ class TeaspnHandlerSample(TeaspnHandler):
         """
         Implements simple word completion with tea variety names
         """
-        COMPLETION_WORDS = [
-            "Assam",
-            "Chai",
-            "Darjeeling",
-            "Earl Grey",
-            "Jasmine",
-            "Matcha",
-            "Oolong",
-            "Puerh"
-        ]
         offset = self._position_to_offset(position)
         context = self._text[:offset]
         query = context.split()[-1]
 
         items = []
-        for word in COMPLETION_WORDS:
-            if word.startswith(query):
-                items.append(CompletionItem(label=word))
+        i = bisect_left(_COMPLETION_WORDS, query)
+        while i < len(_COMPLETION_WORDS) and _COMPLETION_WORDS[i].startswith(query):
+            items.append(CompletionItem(label=_COMPLETION_WORDS[i]))
+            i += 1
 
         return CompletionList(isIncomplete=True, items=items)
 
@@ -32,7 +32,10 @@ class Range(NamedTuple):
         return cls(start=start, end=end)
 
     def to_dict(self):
-        return {'start': self.start.to_dict(), 'end': self.end.to_dict()}
+        # Serializes both positions inline; this is called for every highlight, diagnostic, etc.
+        start, end = self.start, self.end
+        return {'start': {'line': start.line, 'character': start.character},
+                'end': {'line': end.line, 'character': end.character}}
 
 
 class Location(NamedTuple):
@@ -1,6 +1,7 @@
+import bisect
+import functools
 import logging
-import re
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from server.protocol import (
     CodeAction, Command, CompletionList, Diagnostic, Example, Hover, Location,
@@ -10,6 +11,50 @@ from server.protocol import (
 logger = logging.getLogger(__name__)
 
 
+def _line_starts(text: str, base: int = 0) -> List[int]:
+    """
+    Finds the offsets where new lines start in `text`, i.e., right after each newline character.
+
+    Parameters:
+        text (str): text to scan
+        base (int): value added to every offset (e.g., offset of `text` in the document)
+
+    Returns:
+        offsets (List[int]): offsets of line starts, shifted by `base`
+    """
+    offsets = []
+    find = text.find
+    i = find('\n')
+    while i != -1:
+        offsets.append(base + i + 1)
+        i = find('\n', i + 1)
+    return offsets
+
+
+def memoize_per_revision(method):
+    """
+    Decorator for `TeaspnHandler` methods without arguments whose result only depends on the
+    document. The last result is kept together with the document revision it was computed for
+    and returned as is (the same object) until the document changes.
+
+    Only one entry is stored per method and instance, so this is cheaper than `functools.lru_cache`
+    and doesn't keep old documents alive.
+    """
+    cache_attr = f'_{method.__name__}_cache'
+
+    @functools.wraps(method)
+    def wrapper(self):
+        cache = getattr(self, cache_attr, None)
+        if cache is not None and cache[0] == self._revision:
+            return cache[1]
+
+        result = method(self)
+        setattr(self, cache_attr, (self._revision, result))
+        return result
+
+    return wrapper
+
+
 class TeaspnHandler(object):
     """
     This is the abstract base class for handling requests (method calls) from ``TeaspnServer``.
@@ -21,9 +66,13 @@ class TeaspnHandler(object):
     """
     def __init__(self):
         self._line_offsets = [0]
+        self._lines = [""]
         self._uri = None
         self._text = ""
 
+        # Incremented whenever the document changes (see `memoize_per_revision`)
+        self._revision = 0
+
     def _position_to_offset(self, position: Position) -> int:
         """
         Given a Position in the document, converts it to the offset in `self._text`.
@@ -47,21 +96,20 @@ class TeaspnHandler(object):
             position (Position): position in the document
 
         """
-        line = 0
-        for i, n in enumerate(self._line_offsets):
-            if n > offset:
-                line = i - 1
-                break
-
-        character = offset - line
+        line = bisect.bisect_right(self._line_offsets, offset) - 1
+        character = offset - self._line_offsets[line]
         return Position(line=line, character=character)
 
     def _recompute_line_offsets(self):
         """
-        After document updates, recomputes `self._line_offsets`.
+        After document updates, recomputes `self._line_offsets` and `self._lines`.
         """
-        # TODO: Consider \r\n?
-        self._line_offsets = [0] + [m.start() + 1 for m in re.finditer('\n', self._text)]
+        # Lines are split at \n only, so a \r\n line ending leaves the \r at the end of the
+        # previous line and the next line still starts right after the \n.
+        num_old_lines = len(self._lines)
+        self._line_offsets = [0] + _line_starts(self._text)
+        self._lines = self._text.split('\n')
+        self._on_lines_changed(0, num_old_lines, len(self._lines))
 
     def _get_text(self, range: Range) -> str:
         """
@@ -87,16 +135,19 @@ class TeaspnHandler(object):
         Returns:
             line_text (str): text of the line
         """
-        line_offsets_with_sentinel = self._line_offsets + [len(self._text)]
-        return self._text[line_offsets_with_sentinel[line]:line_offsets_with_sentinel[line+1]]
+        start = self._line_offsets[line]
+        if line + 1 < len(self._line_offsets):
+            end = self._line_offsets[line+1]
+        else:
+            end = len(self._text)
+        return self._text[start:end]
 
     def _get_word_at(self, position: Position) -> Optional[str]:
         """Returns the word at position.
 
-        This method gets the text for the cursor line, and then
-        finds the word that encompasses the cursor. This is a bit inefficient, but simple.
-        (otherwise you'd need to scan the string in both directions and find punctuations etc.,
-        which is a lot more complicated, and language dependent).
+        This method gets the text for the cursor line, and then scans it from the cursor in both
+        directions while the characters are word characters (alphanumerics and underscores,
+        as ``\\w`` in regular expressions).
 
         Parameters:
             position (Position): position in the document
@@ -106,12 +157,30 @@ class TeaspnHandler(object):
                 If there's no word at the position, returns None.
         """
         line = self._get_line(position.line)
+        if position.character > len(line):
+            return None
 
-        for match in re.finditer(r'\w+', line):
-            if match.start() <= position.character <= match.end():
-                return match.group(0)
+        start = end = position.character
+        while start > 0 and (line[start-1].isalnum() or line[start-1] == '_'):
+            start -= 1
+        while end < len(line) and (line[end].isalnum() or line[end] == '_'):
+            end += 1
 
-        return None
+        return line[start:end] or None
+
+    def _on_lines_changed(self, start: int, stop: int, count: int):
+        """
+        Called after `self._lines` is updated, where lines [start, stop) of the previous document
+        were replaced by `count` lines beginning at `start`. Lines after them are unchanged but
+        shifted by `count - (stop - start)`. Implementations can override this to keep per-line
+        data (e.g., cached analysis results) in sync with the document.
+
+        Parameters:
+            start (int): first replaced line (0-base)
+            stop (int): line after the last replaced line in the previous document
+            count (int): number of lines inserted in place of the replaced ones
+        """
+        pass
 
     def initialize_document(self, uri: str, text: str):
         """
@@ -125,10 +194,12 @@ class TeaspnHandler(object):
         self._uri = uri
         self._text = text
         self._recompute_line_offsets()
+        self._revision += 1
 
     def update_document(self, range: Range, text: str):
         """
-        Updates document.
+        Updates document. `TeaspnServer` calls `update_document_batch` for each
+        `textDocument/didChange` notification, which calls this method once per change.
 
         Parameters:
             range (Range): range in the document where the update occurs
@@ -137,9 +208,39 @@ class TeaspnHandler(object):
         start_offset = self._position_to_offset(range.start)
         end_offset = self._position_to_offset(range.end)
         self._text = self._text[:start_offset] + text + self._text[end_offset:]
-        self._recompute_line_offsets()
+
+        # Patch `self._line_offsets` in place: lines starting inside the replaced range are
+        # dropped, newlines in `text` are added, and lines after the range are shifted.
+        i = bisect.bisect_right(self._line_offsets, start_offset)
+        j = bisect.bisect_right(self._line_offsets, end_offset)
+        delta = len(text) - (end_offset - start_offset)
+        self._line_offsets[i:] = (_line_starts(text, start_offset)
+                                  + [offset + delta for offset in self._line_offsets[j:]])
+
+        # Likewise, only re-split the lines touched by the update
+        start_line, end_line = range.start.line, range.end.line
+        lines = self._lines
+        new_lines = (lines[start_line][:range.start.character]
+                     + text
+                     + lines[end_line][range.end.character:]).split('\n')
+        lines[start_line:end_line+1] = new_lines
+        self._on_lines_changed(start_line, end_line + 1, len(new_lines))
+        self._revision += 1
         logger.debug('Updated document: text=%s', self._text)
 
+    def update_document_batch(self, changes: List[Tuple[Range, str]]):
+        """
+        Updates document with multiple changes, e.g., all `contentChanges` of a single
+        `textDocument/didChange` notification. Changes are applied in order by `update_document`,
+        each one relative to the document after the previous changes. Implementations can override
+        this to handle all changes of a notification at once.
+
+        Parameters:
+            changes (List[Tuple[Range, str]]): list of (range, text) pairs of the updates
+        """
+        for range, text in changes:
+            self.update_document(range, text)
+
     def highlight_syntax(self) -> List[SyntaxHighlight]:
         """
         Handles syntax highlighting. Based on the current document, computes highlights.
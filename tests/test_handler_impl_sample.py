@@ -0,0 +1,88 @@
+import unittest
+
+from server.handler_impl_sample import TeaspnHandlerSample
+from server.protocol import Position, Range
+
+URI = 'file:///test.txt'
+
+TEXT = ('I are HAPPY\n'
+        'nothing here\n'
+        'you is 42\n'
+        'she were OK')
+
+
+def _range(start_line, start_char, end_line, end_char):
+    return Range(start=Position(line=start_line, character=start_char),
+                 end=Position(line=end_line, character=end_char))
+
+
+class TestIncrementalUpdates(unittest.TestCase):
+    """
+    Checks that incrementally maintained state (line offsets, lines, and per-line caches of
+    highlights and diagnostics) agrees with a handler initialized from scratch after each update.
+    """
+    def setUp(self):
+        self.handler = TeaspnHandlerSample()
+        self.handler.initialize_document(URI, TEXT)
+        # Fill the per-line caches so that later updates have something to invalidate or shift
+        self.handler.highlight_syntax()
+        self.handler.get_diagnostics()
+
+    def assert_in_sync(self, expected_text):
+        fresh = TeaspnHandlerSample()
+        fresh.initialize_document(URI, expected_text)
+
+        self.assertEqual(self.handler._text, expected_text)
+        self.assertEqual(self.handler._line_offsets, fresh._line_offsets)
+        self.assertEqual(self.handler._lines, fresh._lines)
+        self.assertEqual(self.handler.highlight_syntax(), fresh.highlight_syntax())
+
+        diagnostics = self.handler.get_diagnostics()
+        self.assertEqual(diagnostics, fresh.get_diagnostics())
+
+        # Quick fixes must be available for every diagnostic at its current position
+        for diagnostic in diagnostics:
+            actions = self.handler.run_quick_fix(diagnostic.range, [diagnostic])
+            expected = fresh.run_quick_fix(diagnostic.range, [diagnostic])
+            self.assertTrue(actions)
+            self.assertEqual(sorted(a.title for a in actions), sorted(a.title for a in expected))
+
+    def test_insert_newlines(self):
+        self.handler.update_document(_range(0, 0, 0, 0), 'NEW\n\n')
+        self.assert_in_sync('NEW\n\n' + TEXT)
+
+        self.handler.update_document(_range(4, 3, 4, 3), '\nhe am 7')
+        self.assert_in_sync('NEW\n\nI are HAPPY\nnothing here\nyou\nhe am 7 is 42\nshe were OK')
+
+    def test_remove_newlines(self):
+        # Join the first two lines and the last two lines
+        self.handler.update_document(_range(2, 9, 3, 0), ' ')
+        self.handler.update_document(_range(0, 11, 1, 0), ' ')
+        self.assert_in_sync('I are HAPPY nothing here\nyou is 42 she were OK')
+
+        self.handler.update_document(_range(0, 0, 1, 3), 'it')
+        self.assert_in_sync('it is 42 she were OK')
+
+    def test_edit_within_line(self):
+        self.handler.update_document(_range(2, 4, 2, 6), 'are')
+        self.assert_in_sync('I are HAPPY\nnothing here\nyou are 42\nshe were OK')
+
+    def test_batch(self):
+        self.handler.update_document_batch([
+            (_range(1, 0, 1, 12), 'we was\nthey is'),
+            (_range(0, 0, 0, 0), '\n'),
+            (_range(5, 4, 5, 8), 'is'),
+        ])
+        self.assert_in_sync('\nI are HAPPY\nwe was\nthey is\nyou is 42\nshe is OK')
+
+    def test_stale_quick_fix(self):
+        diagnostic = self.handler.get_diagnostics()[0]
+        self.handler.update_document(_range(0, 0, 0, 0), '\n')
+        self.handler.get_diagnostics()
+
+        # The diagnostic moved to the next line, so its old range has no quick fixes
+        self.assertEqual(self.handler.run_quick_fix(diagnostic.range, [diagnostic]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()